@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Feature store of the departments.
+
+The joined DataSet of every (Store, Dept) - store activity fields and sales lags - is built once for all
+departments and saved as .npy files. The files are opened as memory-mapped arrays, so every stage of the
+analysis reads slices of the same data instead of rebuilding it:
+
+- values.npy   - rows of all departments (rows, fields) in float32. Lags of the first weeks are NaN
+- holiday.npy  - raw IsHoliday flag of every row
+- dates.npy    - week of every row
+- offsets.npy  - first row of every department, the last element is the number of rows
+- split.npy    - number of training rows of every department for every lag count
+- keys.npy     - (Store, Dept) of every department
+- columns.json - names of the fields
+
+FeatureStore.open_or_build() opens the files of a previous run instead of building them again, if they
+were built from the same data: a fingerprint of the DataSet (rows, departments, dates and a hash of the
+fields) is kept in columns.json and compared with the current DataSet.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def _sorted(df):
+    return df.sort_values(['Store', 'Dept', 'Date']).reset_index(drop=True)
+
+
+def _fingerprint(df, features):
+    """
+    Fingerprint of the source DataSet, so that a changed source is detected
+    :param df: DataSet sorted by Store, Dept and Date
+    :param features: Store activity fields
+    :return: Dictionary of the number of rows and departments, the date range and a hash of the fields
+    """
+    fields = ['Store', 'Dept', 'Date'] + [f for f in features if f not in ('Store', 'Dept', 'Date')]
+    rows = pd.util.hash_pandas_object(df[fields], index=False).to_numpy()
+    dates = pd.to_datetime(df['Date'])
+    return {
+        'rows': len(df),
+        'departments': int(df.groupby(['Store', 'Dept']).ngroups),
+        'dates': [str(dates.min()), str(dates.max())],
+        'hash': hashlib.sha1(rows.tobytes()).hexdigest(),
+    }
+
+
+class FeatureStore:
+    """
+    Memory-mapped feature store
+    :param path: Directory of the store, created by FeatureStore.build()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        load = lambda name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        self.values = load('values')
+        self.holiday = load('holiday')
+        self.dates = load('dates')
+        self.offsets = load('offsets')
+        self.split = load('split')
+        self.keys = load('keys')
+        with open(os.path.join(path, 'columns.json')) as f:
+            meta = json.load(f)
+        self.columns = meta['columns']
+        self.n_features = meta['n_features']
+        self.max_lags = meta['max_lags']
+        self._index = {(int(s), int(d)): g for g, (s, d) in enumerate(self.keys)}
+
+    @classmethod
+    def build(cls, df, path, features, max_lags=8, test_size=0.3):
+        """
+        Creation of the store from the joined DataSet
+         : param df: DataSet with Store, Dept, Date and input fields
+         : param path: Directory of the store
+         : param features: Store activity fields. The first field is the target, the second one is IsHoliday
+         : param max_lags: Maximal lag shift of the target
+         : param test_size: Part of the last rows of every department used for testing
+         : return: FeatureStore
+        """
+        os.makedirs(path, exist_ok=True)
+        df_s = _sorted(df)
+        group = df_s.groupby(['Store', 'Dept'])
+
+        target = features[0]
+        lags = [group[target].shift(i).rename('%s(t-%d)' % (target, i)) for i in range(1, max_lags + 1)]
+        frame = df_s[features].join(lags)
+
+        sizes = group.size()
+        offsets = np.concatenate([[0], np.cumsum(sizes.to_numpy())])
+        # rows of a department that have all n_lags lags, split like train_test_split(shuffle=False)
+        rows = np.clip(sizes.to_numpy()[:, None] - np.arange(max_lags + 1), 0, None)
+        split = rows - np.ceil(rows * test_size).astype(int)
+
+        arrays = {
+            'values': frame.to_numpy(dtype='float32'),
+            'holiday': df_s['IsHoliday'].to_numpy(dtype=bool),
+            'dates': df_s['Date'].to_numpy(dtype='datetime64[ns]'),
+            'offsets': offsets,
+            'split': split,
+            'keys': sizes.index.to_frame(index=False).to_numpy(),
+        }
+        for name, a in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), a)
+        with open(os.path.join(path, 'columns.json'), 'w') as f:
+            json.dump({'columns': list(frame.columns), 'n_features': len(features), 'max_lags': max_lags,
+                       'test_size': test_size, 'fingerprint': _fingerprint(df_s, features)}, f)
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, df, path, features, max_lags=8, test_size=0.3):
+        """
+        Opening of the store if it was built from the same data with the same fields and lags, otherwise
+        FeatureStore.build()
+        """
+        meta = os.path.join(path, 'columns.json')
+        if os.path.exists(meta):
+            with open(meta) as f:
+                meta = json.load(f)
+            if meta['columns'][:len(features)] == list(features) and meta['max_lags'] == max_lags \
+                    and meta.get('test_size') == test_size \
+                    and meta.get('fingerprint') == _fingerprint(_sorted(df), features):
+                return cls(path)
+        return cls.build(df, path, features, max_lags, test_size)
+
+    def departments(self, rows=None):
+        """
+        (Store, Dept) of all departments
+        :param rows: If given, only departments with this number of rows
+        """
+        if rows is None:
+            return np.asarray(self.keys)
+        return np.asarray(self.keys)[np.diff(self.offsets) == rows]
+
+    def dept(self, St, Dt, n_lags=4):
+        """
+        Slices of one department. Rows without a full lag history are skipped, like in df_hp
+         : param St: Store number
+         : param Dt: Department number
+         : param n_lags: Lag shift, not more than max_lags
+         : return: Input x, target y (rows, 1), IsHoliday mask, dates and number of training rows
+        """
+        if n_lags > self.max_lags:
+            raise ValueError('The store has only %d lags' % self.max_lags)
+        g = self._index[(St, Dt)]
+        start, end = self.offsets[g] + n_lags, self.offsets[g + 1]
+        cols = self.n_features + n_lags
+        x = self.values[start:end, 1:cols]
+        y = self.values[start:end, :1]
+        return x, y, self.holiday[start:end], self.dates[start:end], int(self.split[g, n_lags])
+
+    def input_columns(self, n_lags=4):
+        """
+        Names of the input fields of dept()
+        """
+        return self.columns[1:self.n_features + n_lags]
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Hyperparameter search for the back propagation neural network.
+
+Configurations are compared with successive halving: every configuration is fitted for a few epochs,
+only the best part of them is fitted further, and so on. Hyperband runs several successive halving
+brackets that start with a different number of configurations and epochs.
+
+Trials run in a pool of 'spawn' processes. A spawned worker imports the __main__ module of its parent
+again, and the analysis script (or notebook) runs its whole pipeline at the top level. Therefore search()
+starts this module as a separate Python process, and the pool is created there.
+"""
+
+import itertools
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+search_space = {
+    'units': [(50, 25), (100, 50), (100, 100), (200, 100)],
+    'dropout': [0.1, 0.2, 0.3],
+    'n_lags': [2, 4, 6, 8],
+    'batch_size': [16, 32, 64, 128],
+}
+
+# DataSets of the worker process: {n_lags: (x_train, x_test, y_train, y_test)}
+_datasets = None
+
+
+def BP_model(n_inputs, units=(100, 50), dropout=0.2):
+    """
+    Multilayer neural network with back propagation.
+    :param n_inputs: Number of input fields
+    :param units: Number of neurons of every hidden layer
+    :param dropout: Dropout rate after every hidden layer
+    :return: keras NN model
+    """
+    from keras.models import Sequential
+    from keras.layers import Dense, Dropout
+
+    model = Sequential()
+    model.add(Dense(units[0], input_dim=n_inputs, kernel_initializer='normal', activation='relu'))
+    model.add(Dropout(dropout))
+    for n in units[1:]:
+        model.add(Dense(n, kernel_initializer='normal', activation='relu'))
+        model.add(Dropout(dropout))
+    model.add(Dense(1, kernel_initializer='normal'))
+    model.compile(loss='mean_squared_error', optimizer='adam')
+    return model
+
+
+def sample_configs(n, space=search_space, seed=None):
+    """
+    Random configurations without repetition
+    :param n: Number of configurations
+    :param space: Dictionary of the values of every parameter
+    :param seed: Random seed
+    :return: List of configurations
+    """
+    keys = list(space)
+    grid = list(itertools.product(*(space[k] for k in keys)))
+    rnd = random.Random(seed)
+    return [dict(zip(keys, v)) for v in rnd.sample(grid, min(n, len(grid)))]
+
+
+def _init_worker(datasets, threads):
+    global _datasets
+    _datasets = datasets
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def _run_trial(path, cfg, epochs, initial_epoch, patience):
+    """
+    Fitting of one configuration from initial_epoch to epochs. The model is saved into path, so the next rung continues it.
+    :return: Best validation loss, whether the fitting was stopped by EarlyStopping
+    """
+    from keras.models import load_model
+    from keras.callbacks import EarlyStopping
+
+    x_train, x_test, y_train, y_test = _datasets[cfg['n_lags']]
+    if initial_epoch:
+        model = load_model(path)
+    else:
+        model = BP_model(x_train.shape[1], cfg['units'], cfg['dropout'])
+
+    es = EarlyStopping(monitor='val_loss', mode='auto', patience=patience, restore_best_weights=True)
+    history = model.fit(x_train, y_train, validation_data=(x_test, y_test), epochs=epochs, initial_epoch=initial_epoch,
+                        batch_size=cfg['batch_size'], callbacks=[es], verbose=0)
+    model.save(path)
+    val_loss = history.history['val_loss']
+    return float(np.min(val_loss)), len(val_loss) < epochs - initial_epoch
+
+
+def successive_halving(configs, pool, workdir, min_epochs=5, max_epochs=1000, eta=3, patience=10):
+    """
+    Successive halving of configurations. The remaining configurations are fitted up to max_epochs
+    :param configs: List of configurations
+    :param pool: Executor with initialized workers
+    :param workdir: Directory for the models of the trials
+    :param min_epochs: Epochs of the first rung
+    :param max_epochs: Maximal epochs of a configuration
+    :param eta: Only 1/eta of the configurations is kept after every rung
+    :param patience: EarlyStopping patience inside a trial
+    :return: Best configuration and its validation loss
+    """
+    trials = [{'cfg': c, 'path': os.path.join(workdir, '%d.h5' % i), 'epoch': 0, 'loss': np.inf, 'done': False}
+              for i, c in enumerate(configs)]
+    budget = min_epochs
+    while True:
+        epochs = min(max(1, int(round(budget))), max_epochs)
+        running = [t for t in trials if not t['done']]
+        futures = [pool.submit(_run_trial, t['path'], t['cfg'], epochs, t['epoch'], patience) for t in running]
+        for t, f in zip(running, futures):
+            loss, stopped = f.result()
+            t['loss'] = min(t['loss'], loss)
+            t['epoch'] = epochs
+            t['done'] = stopped or epochs >= max_epochs
+
+        trials.sort(key=lambda t: t['loss'])
+        trials = trials[:max(1, len(trials) // eta)]
+        if all(t['done'] for t in trials):
+            break
+        budget *= eta
+
+    return trials[0]['cfg'], trials[0]['loss']
+
+
+def hyperband(datasets, max_epochs=1000, min_epochs=5, eta=3, n_jobs=None, patience=10, seed=None):
+    """
+    Hyperband search over search_space
+    :param datasets: Dictionary {n_lags: (x_train, x_test, y_train, y_test)} for every value of n_lags in search_space
+    :param max_epochs: Maximal epochs of a configuration
+    :param min_epochs: Minimal epochs of the first rung. It defines the number of brackets
+    :param eta: Only 1/eta of the configurations is kept after every rung
+    :param n_jobs: Number of worker processes
+    :param patience: EarlyStopping patience inside a trial
+    :param seed: Random seed of the configurations
+    :return: Best configuration and its validation loss
+    """
+    n_jobs = n_jobs or os.cpu_count()
+    s_max = max(0, int(math.log(max_epochs / min_epochs, eta)))
+    best_cfg, best_loss = None, np.inf
+
+    ctx = mp.get_context('spawn')
+    with tempfile.TemporaryDirectory() as workdir, \
+            ProcessPoolExecutor(n_jobs, mp_context=ctx, initializer=_init_worker, initargs=(datasets, 1)) as pool:
+        for s in range(s_max, -1, -1):
+            n = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+            configs = sample_configs(n, seed=None if seed is None else seed + s)
+            bracket_dir = os.path.join(workdir, str(s))
+            os.makedirs(bracket_dir)
+            cfg, loss = successive_halving(configs, pool, bracket_dir, max_epochs * eta ** -s, max_epochs, eta, patience)
+            if loss < best_loss:
+                best_cfg, best_loss = cfg, loss
+
+    return best_cfg, best_loss
+
+
+def search(datasets, **kwargs):
+    """
+    hyperband() in a separate Python process. It can be called from any script or notebook
+    :param datasets: Dictionary {n_lags: (x_train, x_test, y_train, y_test)}
+    :param kwargs: Parameters of hyperband()
+    :return: Best configuration and its validation loss
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        arrays = {'%d_%d' % (n, i): a for n, data in datasets.items() for i, a in enumerate(data)}
+        np.savez(os.path.join(workdir, 'datasets.npz'), **arrays)
+        with open(os.path.join(workdir, 'kwargs.json'), 'w') as f:
+            json.dump(kwargs, f)
+        subprocess.run([sys.executable, os.path.abspath(__file__), workdir], check=True)
+        with open(os.path.join(workdir, 'result.json')) as f:
+            result = json.load(f)
+    return result['config'], result['val_loss']
+
+
+def _main(workdir):
+    datasets = {}
+    with np.load(os.path.join(workdir, 'datasets.npz')) as f:
+        for key in f.files:
+            n, i = map(int, key.split('_'))
+            datasets.setdefault(n, [None] * 4)[i] = f[key]
+    with open(os.path.join(workdir, 'kwargs.json')) as f:
+        kwargs = json.load(f)
+    cfg, loss = hyperband({n: tuple(d) for n, d in datasets.items()}, **kwargs)
+    with open(os.path.join(workdir, 'result.json'), 'w') as f:
+        json.dump({'config': cfg, 'val_loss': loss}, f)
+
+
+def save_best(path, group, cfg, loss):
+    """
+    Saving of the best configuration of a group (store type or department cluster) into a JSON file
+    """
+    best = load_best(path)
+    best[str(group)] = {'config': dict(cfg, units=list(cfg['units'])), 'val_loss': loss}
+    with open(path, 'w') as f:
+        json.dump(best, f, indent=2)
+
+
+def load_best(path):
+    """
+    Loading of the best configurations of all groups
+    :return: Dictionary {group: {'config': ..., 'val_loss': ...}}
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    _main(sys.argv[1])
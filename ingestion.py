@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Download of the source DataSets.
+
+All sources are downloaded concurrently into a local cache. Each file is parsed as soon as its own
+download is finished, while the other downloads continue. A download is streamed to a '.part' file, so
+after a failure it is resumed with a Range request instead of starting again. The ETag and Last-Modified
+headers of every file are kept next to it, and the next run sends a conditional request: if the file was
+not modified, the cached copy is used.
+
+Only the standard library is used for HTTP, so any server - e.g. http.server on localhost - can stand in
+for the cloud object storage.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import time
+import urllib.error
+import urllib.request
+from http.client import HTTPException
+
+import pandas as pd
+
+# errors after which the download is retried
+_transient = (urllib.error.URLError, HTTPException, ConnectionError, TimeoutError)
+
+
+def _read_meta(path):
+    if not os.path.exists(path + '.meta.json'):
+        return {}
+    with open(path + '.meta.json') as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    with open(path + '.meta.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def _validators(response):
+    return {k: response.headers[h] for k, h in (('etag', 'ETag'), ('last_modified', 'Last-Modified')) if response.headers.get(h)}
+
+
+def download(url, path, retries=5, backoff=1., chunk_size=1 << 20, timeout=60):
+    """
+    Download of one file with conditional request, resume and retries
+     : param url: Source URL
+     : param path: Cached file
+     : param retries: Number of retries after a transient error
+     : param backoff: Delay before the first retry in seconds, doubled after every retry
+     : param chunk_size: Size of a read block in bytes
+     : param timeout: Socket timeout in seconds
+     : return: Path of the file
+    """
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        meta = _read_meta(path)
+        headers = {}
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if meta.get('complete') and os.path.exists(path):
+            # conditional request of the cached file
+            if 'etag' in meta:
+                headers['If-None-Match'] = meta['etag']
+            if 'last_modified' in meta:
+                headers['If-Modified-Since'] = meta['last_modified']
+        elif offset and (meta.get('etag') or meta.get('last_modified')):
+            # resume of the partial file if it is still the same version
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = meta.get('etag') or meta['last_modified']
+        else:
+            offset = 0
+
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+                if response.status != 206:
+                    offset = 0
+                _write_meta(path, dict(_validators(response), complete=False))
+                with open(part, 'ab' if offset else 'wb') as f:
+                    shutil.copyfileobj(response, f, chunk_size)
+                length = response.headers.get('Content-Length')
+                if length is not None and os.path.getsize(part) != offset + int(length):
+                    raise HTTPException('Incomplete download of %s' % url)
+            os.replace(part, path)
+            _write_meta(path, dict(_read_meta(path), complete=True))
+            return path
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return path
+            if e.code == 416:
+                # the partial file does not match the source any more
+                os.remove(part)
+            elif e.code < 500 or attempt == retries:
+                raise
+        except _transient:
+            if attempt == retries:
+                raise
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    raise HTTPException('Download of %s failed after %d attempts' % (url, retries + 1))
+
+
+async def ingest(sources, cache_dir='data', **kwargs):
+    """
+    Concurrent download and parsing of all sources
+     : param sources: Dictionary {file name: URL}
+     : param cache_dir: Directory of the cached files
+     : param kwargs: Parameters of download()
+     : return: Dictionary {file name: DataFrame}
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    async def load_one(name, url):
+        path = await asyncio.to_thread(download, url, os.path.join(cache_dir, name), **kwargs)
+        return name, await asyncio.to_thread(pd.read_csv, path, delimiter=',')
+
+    return dict(await asyncio.gather(*(load_one(n, u) for n, u in sources.items())))
+
+
+def load(sources, cache_dir='data', **kwargs):
+    """
+    Synchronous version of ingest(). It also works inside a running event loop (e.g. in Jupyter)
+    """
+    coroutine = ingest(sources, cache_dir, **kwargs)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Deferred rendering of the report figures.
+
+The data of every figure is aggregated with NumPy in the main process (means, quantile bands, loss
+histories), then the figures are drawn by a pool of worker processes into PNG files. The main process
+only submits the data and continues, so the models are not waiting for matplotlib.
+
+Drawing with matplotlib holds the GIL, so threads would not draw in parallel. A spawned worker process,
+however, imports the __main__ module of its parent again, and the analysis script (or notebook) runs its
+whole pipeline at the top level. Therefore Report starts this module as a separate Python process, which
+creates the pool, and sends it the figures through a pipe.
+"""
+
+import html
+import multiprocessing as mp
+import os
+import pickle
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def series_stats(values, q=(0.16, 0.84)):
+    """
+    Mean and quantile band of several series
+    :param values: Array (series, points). Missing points are NaN
+    :param q: Lower and upper quantiles. (0.16, 0.84) is the band of one standard deviation
+    :return: mean, lower, upper arrays (points,)
+    """
+    values = np.asarray(values, dtype='float64')
+    lo, hi = np.nanquantile(values, q, axis=0)
+    return np.nanmean(values, axis=0), lo, hi
+
+
+def group_stats(df, by, x, y, q=(0.16, 0.84)):
+    """
+    Mean and quantile band of the field y for every x over the groups
+    :param df: DataFrame
+    :param by: Fields of a group (e.g. ['Store', 'Dept'])
+    :param x: Field of the X axis
+    :param y: Field of the Y axis
+    :return: x values, mean, lower, upper
+    """
+    table = df.pivot_table(index=by, columns=x, values=y, aggfunc='sum')
+    mean, lo, hi = series_stats(table.to_numpy(), q)
+    return table.columns.to_numpy(), mean, lo, hi
+
+
+def loss_history(history):
+    """
+    Loss and validation loss of a keras History as arrays
+    """
+    h = getattr(history, 'history', history)
+    return {'loss': np.asarray(h['loss']), 'val_loss': np.asarray(h.get('val_loss', []))}
+
+
+def _plot_sales(ax, x, mean, lower=None, upper=None, holiday=None, title='Weekly Sales'):
+    ax.plot(x, mean, label='Weekly_Sales')
+    if lower is not None:
+        ax.fill_between(x, lower, upper, alpha=0.3)
+    if holiday is not None:
+        holiday = np.asarray(holiday, dtype=bool)
+        ax.plot(np.asarray(x)[holiday], np.asarray(mean)[holiday], 'o', label='IsHoliday')
+    ax.set_title(title)
+    ax.tick_params(axis='x', rotation=60)
+    ax.legend()
+
+
+def _plot_loss(ax, loss, val_loss, title='Loss'):
+    ax.plot(loss, label='train')
+    if len(val_loss):
+        ax.plot(val_loss, label='test')
+    ax.set_ylabel('loss')
+    ax.set_xlabel('epoch')
+    ax.set_title(title)
+    ax.legend()
+
+
+def _plot_compare(ax, x, series, title='Forecast'):
+    for name, values in series.items():
+        ax.plot(x, values, label=name)
+    ax.set_title(title)
+    ax.legend()
+
+
+def _plot_heatmap(ax, corr, labels, title='Correlation'):
+    import seaborn as sns
+
+    mask = np.triu(np.ones_like(corr, dtype=bool))
+    sns.heatmap(corr, mask=mask, cmap='RdYlGn', vmin=-1., vmax=1., annot=True, center=0, square=True, linewidths=.5,
+                cbar_kws={"shrink": .5}, xticklabels=labels, yticklabels=labels, ax=ax)
+    ax.set_title(title)
+
+
+_plots = {
+    'sales': (_plot_sales, (20, 10)),
+    'loss': (_plot_loss, (8, 5)),
+    'compare': (_plot_compare, (12, 6)),
+    'heatmap': (_plot_heatmap, (11, 9)),
+}
+
+
+def _render(items):
+    """
+    Drawing of several figures in a worker process
+    :param items: List of (path, kind, figsize, data). If figsize is None, the size of the kind is used
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    for path, kind, figsize, data in items:
+        plot, default = _plots[kind]
+        fig = Figure(figsize=figsize or default)
+        FigureCanvasAgg(fig)
+        plot(fig.add_subplot(), **data)
+        fig.savefig(path, bbox_inches='tight')
+
+
+class Report:
+    """
+    Report of figures rendered in the background
+    :param path: Output directory
+    :param n_jobs: Number of worker processes
+    :param chunk: Number of figures sent to a worker at once
+    """
+
+    def __init__(self, path, n_jobs=None, chunk=32):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk = chunk
+        self.figures = []
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(n_jobs or 0)],
+                                        stdin=subprocess.PIPE)
+
+    def submit(self, kind, name, figsize=None, **data):
+        """
+        Adding of one figure. data are the arguments of the plot function of the kind
+        """
+        self.submit_many(kind, [(name, data)], figsize)
+
+    def submit_many(self, kind, items, figsize=None):
+        """
+        Adding of many figures of one kind
+        :param kind: 'sales', 'loss', 'compare' or 'heatmap'
+        :param items: Iterable of (name, data)
+        :param figsize: Size of the figures in inches, the size of the kind by default
+        """
+        if kind not in _plots:
+            raise ValueError('Unknown figure kind: %s' % kind)
+        batch = []
+        for name, data in items:
+            file = '%s.png' % name
+            self.figures.append((name, file))
+            batch.append((os.path.join(os.path.abspath(self.path), file), kind, figsize, data))
+            if len(batch) == self.chunk:
+                self._send(batch)
+                batch = []
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        pickle.dump(batch, self.process.stdin, pickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+
+    def close(self):
+        """
+        Waiting for all figures and writing of index.html
+        :return: Path of index.html
+        """
+        self.process.stdin.close()
+        if self.process.wait():
+            raise subprocess.CalledProcessError(self.process.returncode, self.process.args)
+
+        index = os.path.join(self.path, 'index.html')
+        with open(index, 'w') as f:
+            f.write('<html><body>\n')
+            for name, file in self.figures:
+                f.write('<h3>%s</h3>\n<img src="%s">\n' % (html.escape(name), html.escape(file)))
+            f.write('</body></html>\n')
+        return index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _main(n_jobs):
+    """
+    Rendering of the batches read from stdin until it is closed by Report.close()
+    """
+    ctx = mp.get_context('spawn')
+    with ProcessPoolExecutor(n_jobs or None, mp_context=ctx) as pool:
+        futures = []
+        while True:
+            try:
+                batch = pickle.load(sys.stdin.buffer)
+            except EOFError:
+                break
+            futures.append(pool.submit(_render, batch))
+        for f in futures:
+            f.result()
+
+
+if __name__ == '__main__':
+    _main(int(sys.argv[1]))
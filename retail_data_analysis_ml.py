@@ -24,6 +24,8 @@ Therefore, the main problem I will try to solve in this project is the use of ad
 The statistical data used in this project was obtained from the https://www.kaggle.com/manjeetsingh/retaildataset.
 """
 
+import os
+
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -40,12 +42,27 @@ from keras.layers import Dense
 from keras.layers import Dropout
 from keras.callbacks import EarlyStopping
 from keras.layers import LSTM
+from keras.layers import Masking
+
+import hp_search
+import ingestion
+import reporting
+import scaling
+from feature_store import FeatureStore
 
 """Let's download retail data that relate to the store, department, and regional activity for the given dates.
 
+The three files are downloaded concurrently into the folder **data** (module **ingestion**). Failed downloads are retried and resumed, and on the next run a file is downloaded again only if it was modified on the server.
 """
 
-df1 = pd.read_csv('https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-GPXX0BOFEN/Features%20data%20set.csv', delimiter=',')
+sources = {
+    'Features data set.csv': 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-GPXX0BOFEN/Features%20data%20set.csv',
+    'Sales data set.csv': 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-GPXX0BOFEN/sales%20data-set.csv',
+    'Stores data set.csv': 'https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-GPXX0BOFEN/stores%20data-set.csv',
+}
+data = ingestion.load(sources, 'data')
+
+df1 = data['Features data set.csv']
 df1.dataframeName = 'Features data set.csv'
 df1
 
@@ -63,7 +80,7 @@ df1
 Next, we should download historical sales data which covers the period from 2010-02-05 to 2012-11-01.
 """
 
-df2 = pd.read_csv('https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-GPXX0BOFEN/sales%20data-set.csv', delimiter=',')
+df2 = data['Sales data set.csv']
 df2.dataframeName = 'Sales data set.csv'
 df2
 
@@ -80,7 +97,7 @@ Within this DataSet, we will find the following information:
 The last DataSet contains anonymized information about 45 stores, indicating the type and size of a store.
 """
 
-df3 = pd.read_csv('https://cf-courses-data.s3.us.cloud-object-storage.appdomain.cloud/IBM-GPXX0BOFEN/stores%20data-set.csv', delimiter=',')
+df3 = data['Stores data set.csv']
 df3.dataframeName = 'Stores data set.csv'
 df3
 
@@ -140,6 +157,18 @@ Dt = 50
 df_d = df[(df['Store']==St) & (df['Dept']==Dt)]
 df_d
 
+"""Drawing figures is slow, so most of them are not shown inline. Their data are aggregated with NumPy, and the figures are rendered by background processes into the folder **report** (module **reporting**). The pipeline does not wait for them.
+
+Let's submit the sales of every department right away, so they are drawn while the models are fitted. There are thousands of them, so the figures are smaller.
+"""
+
+report = reporting.Report('report')
+
+df_s = df.sort_values(['Store', 'Dept', 'Date'])
+report.submit_many('sales', (('dept_sales_%d_%d' % k, dict(x=g['Date'].to_numpy(), mean=g['Weekly_Sales'].to_numpy(), holiday=g['IsHoliday'].to_numpy(),
+                                                         title='Store %d, Department %d' % k))
+                             for k, g in df_s.groupby(['Store', 'Dept'])), figsize=(8, 4))
+
 """## Predict the department-wide sales
 
 Let's take the field 'Weekly_Sales' for forecasting. First of all, we should visualize this data.
@@ -152,16 +181,12 @@ _ = sns.lineplot(data = df_d, x = 'Date',y = 'Weekly_Sales', )
 _ = plt.title('LinePlot showing the change in Weekly Sales', fontsize=20)
 plt.show()
 
-"""Let's visualize how sales change during the holidays.
+"""Let's visualize how sales change during the holidays. The figure is saved into the report.
 
 """
 
-plt.figure
-_ = plt.subplots(figsize = (20,10))
-_ = plt.xticks(rotation = 60)
-_ = sns.lineplot(data = df_d, x = 'Date',y = 'Weekly_Sales', hue = 'IsHoliday',style = 'IsHoliday', markers = True, errorbar=('ci', 68))
-_ = plt.title('LinePlot showing the change in Weekly Sales', fontsize=20)
-plt.show()
+report.submit('sales', 'sales_%d_%d' % (St, Dt), x=df_d['Date'].to_numpy(), mean=df_d['Weekly_Sales'].to_numpy(),
+              holiday=df_d['IsHoliday'].to_numpy(), title='Weekly Sales, Store %d, Department %d' % (St, Dt))
 
 """As you can see from the plot, there is no increase in sales on holidays.
 
@@ -379,17 +404,11 @@ It should be noted, that fitting process is very slow. To avoid overfitting and
 es = EarlyStopping(monitor='val_loss', mode='auto', patience=10, verbose=1,  restore_best_weights=True)
 history=estimator.fit(x_train,y_train, validation_data=(x_test,y_test), callbacks=[es]) # Fitting model
 
-"""Let's show [**loss and validation loss dynamics**](https://machinelearningmastery.com/learning-curves-for-diagnosing-machine-learning-model-performance/?utm_medium=Exinfluencer&utm_source=Exinfluencer&utm_content=000026UJ&utm_term=10006555&utm_id=NA-SkillsNetwork-Channel-SkillsNetworkGuidedProjectsIBMGPXX0BOFEN347-2022-01-01).
+"""Let's show [**loss and validation loss dynamics**](https://machinelearningmastery.com/learning-curves-for-diagnosing-machine-learning-model-performance/?utm_medium=Exinfluencer&utm_source=Exinfluencer&utm_content=000026UJ&utm_term=10006555&utm_id=NA-SkillsNetwork-Channel-SkillsNetworkGuidedProjectsIBMGPXX0BOFEN347-2022-01-01) in the report.
 
 """
 
-plt.figure()
-plt.plot(history.history['loss'], label='train')
-plt.plot(history.history['val_loss'], label='test')
-plt.ylabel('loss')
-plt.xlabel('epoch')
-plt.legend()
-plt.show()
+report.submit('loss', 'loss_ANN', **reporting.loss_history(history))
 
 """As you can see, Neural Network is fitting well and no overfitting is observed.
 Let's calculate prediction of the training (**res_train_ANN**) and test (**res_test_ANN**) sets.
@@ -450,17 +469,11 @@ model.compile(loss='mean_squared_error', optimizer='adam')
 
 history = model.fit(train_x_LSTM, y_train, epochs=epochs, batch_size=batch_size, validation_data=(test_x_LSTM, y_test), verbose=1, shuffle=False, callbacks=[es])
 
-"""Let's plot the dynamic of loss and val loss like in the previous case.
+"""Let's save the dynamic of loss and val loss into the report like in the previous case.
 
 """
 
-plt.figure()
-plt.plot(history.history['loss'], label='train')
-plt.plot(history.history['val_loss'], label='test')
-plt.ylabel('loss')
-plt.xlabel('epoch')
-plt.legend()
-plt.show()
+report.submit('loss', 'loss_LSTM', **reporting.loss_history(history))
 
 """Let's calculate our forecast.
 
@@ -482,7 +495,7 @@ print('Mean Absolute Error:', metrics.mean_absolute_error(y_test, res_test_LSTM)
 print('Mean Squared Error:', metrics.mean_squared_error(y_test, res_test_LSTM))
 print('Root Mean Squared Error:', np.sqrt(metrics.mean_squared_error(y_test, res_test_LSTM)))
 
-"""As you can see, the forecast results of the test data set are the same like in the previous models. Let's visualize these 3 results:
+"""As you can see, the forecast results of the test data set are the same like in the previous models. Let's visualize these 3 results in the report:
 
 """
 
@@ -492,13 +505,116 @@ res_pred_test_LSTM = pd.Series(res_test_LSTM, name = 'Predicted test LSTM')
 
 df_2 = pd.DataFrame({'Actual test': res_test, 'Linear Model': res_pred_test_ln, 'ANN Model': res_pred_test_ANN,  'LSTM Model': res_pred_test_LSTM,})
 df_2.index = dataset.index[len(dataset)-len(res_test):]
-df_2.plot()
-plt.show()
+report.submit('compare', 'forecast_lags', x=df_2.index.to_numpy(), series={c: df_2[c].to_numpy() for c in df_2})
 
 """As you can see, all forecasting shows similar results.
 
 None of the models can predict large peaks. However, the positions of the peaks coincide for all the models. That is, this approach allows you to make adequate models. The accuracy of the forecast depends on additional factors which we will try to consider in the next section.
 
+### LSTM on sequence windows of all departments
+
+In the previous LSTM the 4 lags were fed as one timestep of shape (samples, 1, 4), so the recurrent layer had nothing to iterate over. Also, it was fitted on one department only.
+
+Let's feed real windows of shape (samples, n_lags, n_features). Every timestep contains the weekly sales together with the holiday, macro and markdown fields. Windows of all departments are packed into one DataSet, so one training run covers all the series. Each department is normalized with its own min and max. The first weeks of a series do not have a full history, so their windows are padded with a mask value that is skipped by the [**keras.layers.Masking()**](https://keras.io/api/layers/core_layers/masking/) layer.
+"""
+
+seq_features = ['Weekly_Sales', 'IsHoliday', 'Temperature', 'Fuel_Price', 'MarkDown1', 'MarkDown2', 'MarkDown3', 'MarkDown4', 'MarkDown5', 'CPI', 'Unemployment']
+n_lags = 4
+mask_value = -1.
+
+def series_to_windows(df, features, n_lags=4, test_size=0.3, mask_value=-1.):
+    """
+    Transformation of every department into padded lag windows
+     : param df: DataSet with Store, Dept, Date and input fields
+     : param features: Fields of every timestep. The first field is the target
+     : param n_lags: Number of weeks in a window
+     : param test_size: Part of the last windows of every department used for testing
+     : param mask_value: Value of the padded timesteps
+     : return: Windows (samples, n_lags, n_features), normalized target (samples, 1), train mask, target min and range, (Store, Dept) of every window
+    """
+    df_s = df.sort_values(['Store', 'Dept', 'Date'])
+    group = df_s.groupby(['Store', 'Dept'])
+    values = df_s[features].to_numpy(dtype='float32')
+
+    # normalization of every department on its own
+    lo = group[features].transform('min').to_numpy(dtype='float32')
+    span = group[features].transform('max').to_numpy(dtype='float32') - lo
+    span[span == 0] = 1
+    values = (values - lo) / span
+
+    # position of every row inside its department
+    pos = group.cumcount().to_numpy()
+    size = group['Weekly_Sales'].transform('size').to_numpy()
+
+    # a window is created for every week that has at least one previous week
+    rows = np.flatnonzero(pos > 0)
+    shift = np.arange(n_lags, 0, -1)
+    valid = pos[rows, None] >= shift
+    windows = values[np.where(valid, rows[:, None] - shift, 0)]
+    windows[~valid] = mask_value
+
+    # the last windows of every department are used for testing, like train_test_split(shuffle=False)
+    n_windows = size[rows] - 1
+    is_train = pos[rows] - 1 < n_windows - np.ceil(n_windows * test_size)
+
+    keys = df_s[['Store', 'Dept']].to_numpy()[rows]
+    return windows, values[rows, :1], is_train, lo[rows, 0], span[rows, 0], keys
+
+"""Let's create the DataSet of all departments:
+
+"""
+
+windows, target, is_train, target_lo, target_span, keys = series_to_windows(df, seq_features, n_lags, mask_value=mask_value)
+train_x_seq, train_y_seq = windows[is_train], target[is_train]
+test_x_seq, test_y_seq = windows[~is_train], target[~is_train]
+print("Train windows:", train_x_seq.shape)
+print("Test windows: ", test_x_seq.shape)
+
+"""The network is the same as the previous one, but the Masking layer is added in front of the LSTM. Since all departments are fitted together, we can use a large batch size that keeps all CPU cores busy.
+
+"""
+
+def LSTM_seq_model(n_lags, n_features, mask_value=-1.):
+    """
+    LSTM neural network over masked sequence windows.
+    :param n_lags: Number of timesteps in a window
+    :param n_features: Number of fields in a timestep
+    :param mask_value: Value of the padded timesteps
+    :return: keras NN model
+    """
+    # create model
+    model = Sequential()
+    model.add(Masking(mask_value=mask_value, input_shape=(n_lags, n_features)))
+    model.add(LSTM(100))
+    model.add(Dropout(0.2))
+    model.add(Dense(100, kernel_initializer='normal', activation='relu'))
+    model.add(Dropout(0.2))
+    model.add(Dense(1))
+    # Compile model
+    model.compile(loss='mean_squared_error', optimizer='adam')
+    return model
+
+model_seq = LSTM_seq_model(n_lags, len(seq_features), mask_value)
+es = EarlyStopping(monitor='val_loss', mode='auto', patience=10, verbose=1, restore_best_weights=True)
+history = model_seq.fit(train_x_seq, train_y_seq, epochs=epochs, batch_size=1024, validation_data=(test_x_seq, test_y_seq), verbose=1, callbacks=[es])
+
+report.submit('loss', 'loss_LSTM_seq', **reporting.loss_history(history))
+
+"""Let's calculate the forecast for our department and return it to real scale:
+
+"""
+
+sel = (keys[:, 0] == St) & (keys[:, 1] == Dt) & ~is_train
+res_test_seq = model_seq.predict(windows[sel]).flatten() * target_span[sel] + target_lo[sel]
+res_test_seq_real = target[sel].flatten() * target_span[sel] + target_lo[sel]
+
+print("Correlation test", np.corrcoef(res_test_seq_real, res_test_seq)[0,1])
+print('Mean Absolute Error:', metrics.mean_absolute_error(res_test_seq_real, res_test_seq))
+print('Mean Squared Error:', metrics.mean_squared_error(res_test_seq_real, res_test_seq))
+print('Root Mean Squared Error:', np.sqrt(metrics.mean_squared_error(res_test_seq_real, res_test_seq)))
+
+"""One model now serves all departments, and each forecast uses the real sequence of the previous weeks together with the store activity.
+
 ## Model the effects of markdowns on holiday weeks
 
 To take into account the impact of markdowns on sales on holidays, we should first build a model of sales forecasting depending on other input parameters.
@@ -547,21 +663,119 @@ my_headmap(df_d.corr())
 
 """As you can see there are no fields that lineary impact on Weekly Sales.
 
-Let's create our DataSet. To do this, join our historical 4 weeks sales data to this dataset.
+### Correlation profiles of all departments
+
+Computing and drawing the correlation matrix for every department one by one takes thousands of calls. Let's calculate the matrices of all departments in one pass. To do this, the departments are stacked into a 3D array (departments, weeks, fields) padded with empty weeks, and covariances are calculated with [**numpy.einsum()**](https://numpy.org/doc/stable/reference/generated/numpy.einsum.html).
+
+Together with the correlation matrix we calculate a sensitivity profile: standardized coefficients of a linear model of Weekly_Sales on the other fields.
+"""
+
+def batch_corr(df, features, ridge=1e-3):
+    """
+    Correlation matrices and sensitivity profiles of all departments
+     : param df: DataSet with Store, Dept, Date and input fields
+     : param features: Fields of the matrix. The first field is the target
+     : param ridge: Regularization of the linear model
+     : return: (Store, Dept) of every department, correlation matrices (departments, fields, fields), sensitivity profiles (departments, fields - 1)
+    """
+    df_s = df.sort_values(['Store', 'Dept', 'Date'])
+    group = df_s.groupby(['Store', 'Dept'])
+    codes = group.ngroup().to_numpy()
+    pos = group.cumcount().to_numpy()
+
+    # departments padded to the same number of weeks
+    values = np.zeros((codes.max() + 1, pos.max() + 1, len(features)))
+    mask = np.zeros(values.shape[:2])
+    values[codes, pos] = df_s[features].to_numpy(dtype='float64')
+    mask[codes, pos] = 1
+
+    n = mask.sum(axis=1)[:, None]
+    mean = values.sum(axis=1) / n
+    centered = (values - mean[:, None, :]) * mask[:, :, None]
+    cov = np.einsum('gti,gtj->gij', centered, centered) / n[:, :, None]
+
+    std = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / (std[:, :, None] * std[:, None, :])
+    # constant fields (e.g. markdowns that are always 0) have no correlation
+    corr = np.nan_to_num(corr)
+
+    # standardized linear coefficients of the target on other fields
+    eye = np.eye(len(features) - 1)
+    sens = np.linalg.solve(corr[:, 1:, 1:] * (1 - eye) + eye * (1 + ridge), corr[:, 1:, 0][..., None])[..., 0]
+
+    keys = group.size().index.to_frame(index=False).to_numpy()
+    return keys, corr, sens
+
+keys_corr, corr_all, sens_all = batch_corr(df, seq_features)
+print("Correlation matrices:", corr_all.shape)
+
+"""Now we can group departments with similar profiles using [**sklearn.cluster.KMeans()**](https://scikit-learn.org/stable/modules/generated/sklearn.cluster.KMeans.html). Each department is described by the upper triangle of its correlation matrix and its sensitivity profile.
+
+"""
+
+from sklearn.cluster import KMeans
+
+def cluster_depts(keys, corr, sens, n_clusters=8):
+    """
+    Clustering of departments by correlation and sensitivity profiles
+     : param keys: (Store, Dept) of every department
+     : param corr: Correlation matrices
+     : param sens: Sensitivity profiles
+     : param n_clusters: Number of clusters
+     : return: DataFrame with the cluster of every department, index of the representative department of every cluster
+    """
+    iu = np.triu_indices(corr.shape[1], k=1)
+    profiles = np.hstack([corr[:, iu[0], iu[1]], sens])
+
+    km = KMeans(n_clusters=n_clusters, n_init=10, random_state=0).fit(profiles)
+    dist = np.linalg.norm(profiles - km.cluster_centers_[km.labels_], axis=1)
+    representatives = [np.flatnonzero(km.labels_ == k)[np.argmin(dist[km.labels_ == k])] for k in range(n_clusters)]
+
+    clusters = pd.DataFrame({'Store': keys[:, 0], 'Dept': keys[:, 1], 'Cluster': km.labels_})
+    return clusters, representatives
+
+dept_clusters, representatives = cluster_depts(keys_corr, corr_all, sens_all)
+dept_clusters['Cluster'].value_counts()
+
+"""Instead of thousands of heatmaps, it is enough to look at one representative department of every cluster. The clusters can also be used to fit one model per cluster instead of one model per department.
+
+"""
+
+for k, r in enumerate(representatives):
+    print('Cluster:', k, 'Store:', keys_corr[r, 0], 'Department:', keys_corr[r, 1])
+report.submit_many('heatmap', [('corr_cluster_%d' % k, dict(corr=corr_all[r], labels=seq_features, title='Cluster %d' % k))
+                               for k, r in enumerate(representatives)])
+
+"""Let's also add the average sales of every cluster with the band of one standard deviation into the report. The bands are calculated with quantiles instead of bootstrapped confidence intervals.
+
+"""
+
+df_c = df.merge(dept_clusters, on=['Store', 'Dept'])
+for k, g in df_c.groupby('Cluster'):
+    x, mean, lower, upper = reporting.group_stats(g, ['Store', 'Dept'], 'Date', 'Weekly_Sales')
+    report.submit('sales', 'cluster_sales_%d' % k, x=x, mean=mean, lower=lower, upper=upper, title='Cluster %d' % k)
+
+"""Let's create our DataSet. To do this, join our historical 4 weeks sales data to this dataset.
 """
 
 df_hp = df_d.join(dataset[dataset.columns[1:-1]])
 df_hp = df_hp.dropna()
 df_hp
 
-"""Let's create the input and target fields:
+"""The same DataSet is needed for every department in all the next steps: training, sensitivity analysis and scenarios. Instead of rebuilding it every time, let's build a feature store (module **feature_store**) once for all departments. It keeps the joined fields with up to 8 sales lags, the raw IsHoliday flags and the train/test split of every department in memory-mapped files, and returns slices of them. If the store was built on a previous run, it is only opened.
 
 """
 
-col = df_hp.columns
-X, Y = df_hp[col[1:]], df_hp[col[0]]
-print("Input: ", X.columns)
-print("Target:", Y.name)
+store = FeatureStore.open_or_build(df, 'feature_store', seq_features, max_lags=8)
+
+"""Let's take the input and target fields of our department from the feature store. They are the same as in df_hp:
+
+"""
+
+X, Y, holiday, dates, split = store.dept(St, Dt)
+print("Input: ", store.input_columns())
+print("Target:", store.columns[0])
 
 """Normalize them:
 
@@ -570,13 +784,13 @@ print("Target:", Y.name)
 scaler_x = MinMaxScaler(feature_range=(0, 1))
 scaler_y = MinMaxScaler(feature_range=(0, 1))
 scaled_x = scaler_x.fit_transform(X)
-scaled_y = scaler_y.fit_transform(Y.values.reshape(-1, 1))
+scaled_y = scaler_y.fit_transform(Y)
 
-"""And split them into training and test sets:
+"""And split them into training and test sets. The store keeps the number of training rows, which gives the same 70/30 split without shuffling:
 
 """
 
-x_train, x_test, y_train, y_test = train_test_split(scaled_x, scaled_y, test_size=0.3, shuffle=False)
+x_train, x_test, y_train, y_test = scaled_x[:split], scaled_x[split:], scaled_y[:split], scaled_y[split:]
 
 """We make inverse transform to get the training and test sets in real scale.
 
@@ -610,22 +824,16 @@ print('Root Mean Squared Error:', np.sqrt(metrics.mean_squared_error(y_test, y_p
 Let's use the same Neural Network as in the previous task.
 """
 
-def BP_model(X):
+def BP_model(X, units=(100, 50), dropout=0.2):
     """
     Multilayer neural network with back propagation .
+    The network is built by hp_search.BP_model(), so the searched and the fitted architectures are the same.
     :param X: Input DataSet
+    :param units: Number of neurons of every hidden layer
+    :param dropout: Dropout rate after every hidden layer
     :return: keras NN model
     """
-    # create model
-    model = Sequential()
-    model.add(Dense(100, input_dim=X.shape[1], kernel_initializer='normal', activation='relu'))
-    model.add(Dropout(0.2))
-    model.add(Dense(50, kernel_initializer='normal', activation='relu'))
-    model.add(Dropout(0.2))
-    model.add(Dense(1, kernel_initializer='normal'))
-    # Compile model
-    model.compile(loss='mean_squared_error', optimizer='adam')
-    return model
+    return hp_search.BP_model(X.shape[1], units, dropout)
 
 epochs = 1000
 batch_size=int(y_train.shape[0]*.1)
@@ -638,17 +846,11 @@ estimator = KerasRegressor(build_fn=BP_model, X=x_train, epochs=epochs, batch_si
 es = EarlyStopping(monitor='val_loss', mode='auto', patience=10, verbose=1, restore_best_weights=True)
 history=estimator.fit(x_train,y_train, validation_data=(x_test,y_test), callbacks=[es])
 
-"""Let's show [**loss and validation loss dynamics**](https://machinelearningmastery.com/learning-curves-for-diagnosing-machine-learning-model-performance/?utm_medium=Exinfluencer&utm_source=Exinfluencer&utm_content=000026UJ&utm_term=10006555&utm_id=NA-SkillsNetwork-Channel-SkillsNetworkGuidedProjectsIBMGPXX0BOFEN347-2022-01-01).
+"""Let's show [**loss and validation loss dynamics**](https://machinelearningmastery.com/learning-curves-for-diagnosing-machine-learning-model-performance/?utm_medium=Exinfluencer&utm_source=Exinfluencer&utm_content=000026UJ&utm_term=10006555&utm_id=NA-SkillsNetwork-Channel-SkillsNetworkGuidedProjectsIBMGPXX0BOFEN347-2022-01-01) in the report.
 
 """
 
-plt.figure()
-plt.plot(history.history['loss'], label='train')
-plt.plot(history.history['val_loss'], label='test')
-plt.ylabel('loss')
-plt.xlabel('epoch')
-plt.legend()
-plt.show()
+report.submit('loss', 'loss_ANN_markdowns', **reporting.loss_history(history))
 
 """As you can see, the Neural Network is fitting well and no overfitting is observed.
 Let's calculate the prediction of training (**res_train_ANN**) an test (**res_test_ANN**) sets.
@@ -671,7 +873,7 @@ print('Mean Absolute Error:', metrics.mean_absolute_error(y_test, res_test_ANN))
 print('Mean Squared Error:', metrics.mean_squared_error(y_test, res_test_ANN))
 print('Root Mean Squared Error:', np.sqrt(metrics.mean_squared_error(y_test, res_test_ANN)))
 
-"""As you can see, the forecast results of the test data set are much better than ones of the previous models. Let's visualize these 2 results:
+"""As you can see, the forecast results of the test data set are much better than ones of the previous models. Let's visualize these 2 results in the report:
 
 """
 
@@ -679,13 +881,77 @@ res_pred_test_ln = pd.Series(y_pred_test_ln, name = 'Predicted test Linear Model
 res_pred_test_ANN = pd.Series(res_test_ANN, name = 'Predicted test ANN')
 
 df_2 = pd.DataFrame({'Actual test': res_test, 'Linear Model': res_pred_test_ln, 'ANN Model': res_pred_test_ANN})
-df_2.index = df_d.index[len(df_d)-len(res_test):]
-df_2.plot()
-plt.show()
+df_2.index = dates[split:]
+report.submit('compare', 'forecast_markdowns', x=df_2.index.to_numpy(), series={c: df_2[c].to_numpy() for c in df_2})
 
 """As you can see from the plot, an ANN shows better results.
 
-Let's calculate the sensitivity of week sales for other factors.
+### Hyperparameter search
+
+The number of neurons, the dropout rate, the lag count and the batch size were chosen by hand. Fitting every combination for 1000 epochs is too slow, so let's use [**Hyperband**](https://arxiv.org/abs/1603.06560): all configurations are fitted for a few epochs, only the best third of them is fitted further, and so on. The trials run in parallel processes (module **hp_search**). The search itself is started as a separate Python process, so the workers never import this script or notebook again.
+
+First of all, we need a function that creates the training and test DataSets of one department for any lag count.
+"""
+
+def dept_dataset(store, St, Dt, n_lags=4):
+    """
+    Normalized DataSet of the store activity and the sales lags of one department
+     : param store: FeatureStore of all departments
+     : param St: Store number
+     : param Dt: Department number
+     : param n_lags: Lag shift
+     : return: x_train, x_test, y_train, y_test, scaler_x, scaler_y
+    """
+    x, y, holiday, dates, split = store.dept(St, Dt, n_lags)
+    scaler_x, scaler_y = scaling.MinMaxState(), scaling.MinMaxState()
+    # one float32 copy out of the read-only store, normalized in place
+    scaled_x = scaler_x.fit_transform(x, copy=True)
+    scaled_y = scaler_y.fit_transform(y, copy=True)
+    return scaled_x[:split], scaled_x[split:], scaled_y[:split], scaled_y[split:], scaler_x, scaler_y
+
+def group_dataset(store, depts, n_lags=4):
+    """
+    DataSets of several departments joined together
+     : param depts: List of (Store, Dept)
+     : return: x_train, x_test, y_train, y_test
+    """
+    parts = [dept_dataset(store, s, d, n_lags)[:4] for s, d in depts]
+    return tuple(np.concatenate(p) for p in zip(*parts))
+
+"""Let's find the best configuration for every store type on 20 random departments of this type and save it into **best_config.json**.
+
+"""
+
+store_depts = df[['Store', 'Dept', 'Type']].value_counts().reset_index(name='rows')
+store_depts = store_depts[store_depts['rows'] == 143]
+
+for t, g in store_depts.groupby('Type'):
+    depts = g[['Store', 'Dept']].sample(min(20, len(g)), random_state=0).values
+    datasets = {n: group_dataset(store, depts, n) for n in hp_search.search_space['n_lags']}
+    cfg, loss = hp_search.search(datasets, max_epochs=epochs, seed=0)
+    hp_search.save_best('best_config.json', t, cfg, loss)
+    print('Type:', t, cfg, 'val_loss: %.5f' % loss)
+
+"""Now we can fit our department with the best configuration of its store type:
+
+"""
+
+store_type = df[df['Store']==St]['Type'].iloc[0]
+cfg = hp_search.load_best('best_config.json')[str(store_type)]['config']
+x_train_b, x_test_b, y_train_b, y_test_b, scaler_x_b, scaler_y_b = dept_dataset(store, St, Dt, cfg['n_lags'])
+estimator_b = KerasRegressor(build_fn=BP_model, X=x_train_b, units=cfg['units'], dropout=cfg['dropout'], epochs=epochs, batch_size=cfg['batch_size'], verbose=0)
+history = estimator_b.fit(x_train_b, y_train_b, validation_data=(x_test_b, y_test_b), callbacks=[es])
+print('Validation loss with the best configuration:', min(history.history['val_loss']))
+
+"""The scalers are saved together with the model, so the model can be used later without the training data. When new weeks arrive, the scalers are updated with partial_fit().
+
+"""
+
+os.makedirs('models', exist_ok=True)
+estimator_b.model.save('models/%d_%d.h5' % (St, Dt))
+scaling.save('models/%d_%d_scalers.npz' % (St, Dt), x=scaler_x_b, y=scaler_y_b)
+
+"""Let's calculate the sensitivity of week sales for other factors.
 
 ### Sensitivity analysis
 
@@ -711,18 +977,17 @@ def my_sens(regressor, x, c, p):
 
 """
 
-for i,c in enumerate(df_hp.columns[2:]):
+for i,c in enumerate(store.input_columns()[1:]):
     print("Sensitivity of Week Sales on %s: %5.2f%%" % (c, my_sens(estimator, x_test, i+1,  0.1) * 100))
 
 """As can be seen from the results, this department is not sensitive to the impact of discounts on weekdays.
 
-Let's analyze the impact of markdowns during the holiday week. To do this, we will create an input matrix that contains only information about the holidays.
+Let's analyze the impact of markdowns during the holiday week. To do this, we will create an input matrix that contains only information about the holidays. The rows are selected with the raw IsHoliday flags, so they do not depend on the normalization.
 """
 
-x_test2 = [list(x) for x in x_test if x[0]>=0.99]
-x_test2 = np.array(x_test2)
+x_test2 = x_test[holiday[split:]]
 
-for i,c in enumerate(df_hp.columns[2:]):
+for i,c in enumerate(store.input_columns()[1:]):
     print("Sensitivity of Week Sales in Holiday on %s: %5.2f%%" % (c, my_sens(estimator, x_test2, i+1,  0.1) * 100))
 
 """As you can see, the holiday week is not sensitive for markdowns too.
@@ -740,37 +1005,17 @@ It can also be seen that the sales intensity of this department have 2 weeks cyc
 3. Calculate the sensitivity for any 10 departments, that have 143 rows in the DataSet.
 """
 
-def sens_holiday(df, St, Dt):
-    # DataSet creation
-    df_d = df[(df['Store']==St) & (df['Dept']==Dt)]
-
-    # Week Sales Time Series creation
-    ts = df_d[['Date', 'Weekly_Sales']]
-    ts = ts.set_index('Date') ts = ts['Weekly_Sales']
+def sens_holiday(store, St, Dt, path=None):
+    # DataSet from the feature store
+    x, y, holiday, dates, split = store.dept(St, Dt)
 
-    # Week Sales DataSet creation
-    ts_dataset = series_to_supervised(pd.DataFrame(ts), ts, 4)
-    df_d = df_d.set_index('Date')
-    df_d = df_d[['Weekly_Sales', 'IsHoliday', 'Temperature', 'Fuel_Price', 'MarkDown1', 'MarkDown2', 'MarkDown3', 'MarkDown4', 'MarkDown5', 'CPI', 'Unemployment']]
-    df_hp = df_d.join(ts_dataset[ts_dataset.columns[1:-1]])
-    df_hp = df_hp.dropna()
+    # Normalization into float32 buffers shared with keras
+    scaler_x, scaler_y = scaling.MinMaxState(), scaling.MinMaxState()
+    scaled_x = scaler_x.fit_transform(x, copy=True)
+    scaled_y = scaler_y.fit_transform(y, copy=True)
 
-    # Splitting on Input and Target
-    col = df_hp.columns
-    X, Y = df_hp[col[1:]], df_hp[col[0]]
-
-    # Normalization
-    scaler_x = MinMaxScaler(feature_range=(0, 1))
-    scaler_y = MinMaxScaler(feature_range=(0, 1))
-    scaled_x = scaler_x.fit_transform(X)
-    scaled_y = scaler_y.fit_transform(Y.values.reshape(-1, 1))
-
-    # Creation Train and Test DataSets
-    x_train, x_test, y_train, y_test = train_test_split(scaled_x, scaled_y, test_size=0.3, shuffle=False)
-
-    # Real scale target
-    res_train = scaler_y.inverse_transform(y_train).flatten()
-    res_test = scaler_y.inverse_transform(y_test).flatten()
+    # Creation Train and Test DataSets (views, not copies)
+    x_train, x_test, y_train, y_test = scaled_x[:split], scaled_x[split:], scaled_y[:split], scaled_y[split:]
 
     # ANN Creation and fitting
     epochs = 1000
@@ -779,14 +1024,20 @@ def sens_holiday(df, St, Dt):
     es = EarlyStopping(monitor='val_loss', mode='auto', patience=10, verbose=1, restore_best_weights=True)
     history=estimator.fit(x_train,y_train, validation_data=(x_test,y_test), callbacks=[es])
 
+    # Saving the model with its scalers
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        estimator.model.save(os.path.join(path, '%d_%d.h5' % (St, Dt)))
+        scaling.save(os.path.join(path, '%d_%d_scalers.npz' % (St, Dt)), x=scaler_x, y=scaler_y)
+
     # Creation Holidays DataSet
-    x_test2 = [list(x) for x in x_test if x[0]>=0.99] x_test2 = np.array(x_test2)
+    x_test2 = x_test[holiday[split:]]
 
     # Sensitivity calculation
     res = {}
     res['Store'] = [St]
     res['Department'] = [Dt]
-    for i,c in enumerate(df_hp.columns[2:]):
+    for i,c in enumerate(store.input_columns()[1:]):
        res[c] = ["{:.2f}%".format(my_sens(estimator, x_test2, i+1, 0.1)*100)]
     res = pd.DataFrame(res)
     res = res.set_index(['Store', 'Department'])
@@ -796,23 +1047,36 @@ def sens_holiday(df, St, Dt):
 
 """
 
-sens_holiday(df, 1, 1)
+sens_holiday(store, 1, 1)
 
 """###Sensitivity of 10 departments
 
 """
 
 # filter departments with 143 rows
-depts = df[['Store', 'Dept']].value_counts() depts = depts[depts == 143] depts.name = 'rows' depts
+depts = store.departments(rows=143)
+depts
 
 # shuffle depts
-depts = depts.reset_index() shuffled_dt = depts.reindex(np.random.permutation(depts.index)) shuffled_dt
+shuffled_dt = np.random.permutation(depts)
+shuffled_dt
 
-# sensitivity calculation
-sens = pd.DataFrame() for v in shuffled_dt.values[:10]: print('Store:', v[0], 'Department:', v[1]) sens = sens.append(sens_holiday(df, v[0], v[1]))
+# sensitivity calculation, the models are saved with their scalers into the folder models
+sens = []
+for v in shuffled_dt[:10]:
+    print('Store:', v[0], 'Department:', v[1])
+    sens.append(sens_holiday(store, v[0], v[1], path='models'))
+sens = pd.concat(sens)
 
 sens
 
+"""## Report
+
+Finally, let's wait for the background processes and write **report/index.html**. The figures of all departments and clusters were submitted at the beginning, so most of them are already drawn while the models were fitted.
+"""
+
+print('Report:', report.close())
+
 """## Conclusions
 
 During this project, we demonstrated how to analyze and forecast store sales.
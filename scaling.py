@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Min-max normalization with running state.
+
+MinMaxState works like sklearn.preprocessing.MinMaxScaler with feature_range=(0, 1), but:
+
+- fit() starts from scratch, like in sklearn, while partial_fit() updates the min and max incrementally,
+  e.g. when new weeks arrive;
+- transform() and inverse_transform() work in place on float32 arrays, so the buffers passed to keras
+  are not copied and converted at every step;
+- the state is saved next to the model with save() and restored with load().
+"""
+
+import numpy as np
+
+
+def _buffer(x, copy):
+    """
+    float32 array for in-place operations. x itself is returned if it is already a writable float32 array
+    """
+    if not copy and isinstance(x, np.ndarray) and x.dtype == np.float32 and x.flags.writeable:
+        return x
+    return np.array(x, dtype=np.float32)
+
+
+class MinMaxState:
+    """
+    Running min-max scaler to the range [0, 1]
+    """
+
+    def __init__(self):
+        self.data_min = None
+        self.data_max = None
+        self.n_samples = 0
+
+    @property
+    def scale(self):
+        span = self.data_max - self.data_min
+        return np.where(span == 0, 1, span).astype(np.float32)
+
+    def fit(self, x):
+        """
+        Min and max of x. The previous state is discarded
+        :param x: Array (rows, fields)
+        :return: self
+        """
+        self.data_min, self.data_max, self.n_samples = None, None, 0
+        return self.partial_fit(x)
+
+    def partial_fit(self, x):
+        """
+        Update of the min and max with new rows
+        :param x: Array (rows, fields)
+        :return: self
+        """
+        x = np.asarray(x)
+        if not len(x):
+            return self
+        lo = np.nanmin(x, axis=0).astype(np.float32)
+        hi = np.nanmax(x, axis=0).astype(np.float32)
+        if self.data_min is None:
+            self.data_min, self.data_max = lo, hi
+        else:
+            np.minimum(self.data_min, lo, out=self.data_min)
+            np.maximum(self.data_max, hi, out=self.data_max)
+        self.n_samples += len(x)
+        return self
+
+    def transform(self, x, copy=False):
+        """
+        Normalization. A writable float32 array is changed in place unless copy is True
+        :return: Normalized float32 array
+        """
+        x = _buffer(x, copy)
+        x -= self.data_min
+        x /= self.scale
+        return x
+
+    def fit_transform(self, x, copy=False):
+        return self.fit(x).transform(x, copy)
+
+    def inverse_transform(self, x, copy=False):
+        """
+        Return to real scale. A writable float32 array is changed in place unless copy is True
+        :return: float32 array in real scale
+        """
+        x = _buffer(x, copy)
+        x *= self.scale
+        x += self.data_min
+        return x
+
+
+def save(path, **scalers):
+    """
+    Saving of several scalers into one .npz file, e.g. save(path, x=scaler_x, y=scaler_y)
+    """
+    arrays = {}
+    for name, s in scalers.items():
+        arrays[name + '_min'] = s.data_min
+        arrays[name + '_max'] = s.data_max
+        arrays[name + '_n'] = s.n_samples
+    np.savez(path, **arrays)
+
+
+def load(path):
+    """
+    Loading of the scalers saved by save()
+    :return: Dictionary {name: MinMaxState}
+    """
+    scalers = {}
+    with np.load(path) as f:
+        for key in f.files:
+            if key.endswith('_min'):
+                name = key[:-4]
+                s = MinMaxState()
+                s.data_min, s.data_max, s.n_samples = f[key], f[name + '_max'], int(f[name + '_n'])
+                scalers[name] = s
+    return scalers
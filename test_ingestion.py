@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Tests of ingestion against a local stand-in HTTP server."""
+
+import json
+import os
+import threading
+from http.client import HTTPException
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ingestion
+
+BODY = b''.join(b'%d,%d\n' % (i, i * i) for i in range(20000))
+
+
+class Source(BaseHTTPRequestHandler):
+    """
+    File with an ETag, conditional requests and ranges. truncate cuts the body of the next response
+    """
+    body = BODY
+    etag = '"v1"'
+    truncate = None
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+
+        body, status = self.body, 200
+        rng = self.headers.get('Range')
+        if rng and self.headers.get('If-Range', self.etag) == self.etag:
+            start = int(rng[len('bytes='):-1])
+            if start >= len(self.body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(self.body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body, status = self.body[start:], 206
+
+        self.send_response(status)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (len(self.body) - len(body), len(self.body) - 1,
+                                                                 len(self.body)))
+        self.end_headers()
+        if type(self).truncate is not None:
+            body, type(self).truncate = body[:type(self).truncate], None
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    Source.body, Source.etag, Source.truncate, Source.requests = BODY, '"v1"', None, []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Source)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d/data.csv' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_not_modified_file_is_taken_from_cache(url, tmp_path):
+    path = str(tmp_path / 'data.csv')
+    ingestion.download(url, path)
+    ingestion.download(url, path)
+
+    assert read(path) == BODY
+    assert Source.requests[1]['If-None-Match'] == '"v1"'
+    assert len(Source.requests) == 2
+
+
+def test_modified_file_is_downloaded_again(url, tmp_path):
+    path = str(tmp_path / 'data.csv')
+    ingestion.download(url, path)
+    Source.body, Source.etag = BODY[::-1], '"v2"'
+    ingestion.download(url, path)
+
+    assert read(path) == BODY[::-1]
+
+
+def test_truncated_body_is_resumed(url, tmp_path):
+    path = str(tmp_path / 'data.csv')
+    Source.truncate = 50000
+    ingestion.download(url, path, backoff=0, chunk_size=4096)
+
+    assert read(path) == BODY
+    assert Source.requests[1]['Range'] == 'bytes=50000-'
+    assert Source.requests[1]['If-Range'] == '"v1"'
+    assert not os.path.exists(path + '.part')
+
+
+def test_part_of_another_version_is_downloaded_again(url, tmp_path):
+    path = str(tmp_path / 'data.csv')
+    with open(path + '.part', 'wb') as f:
+        f.write(b'old data')
+    with open(path + '.meta.json', 'w') as f:
+        json.dump({'etag': '"v0"', 'complete': False}, f)
+    ingestion.download(url, path)
+
+    assert read(path) == BODY
+    assert Source.requests[0]['If-Range'] == '"v0"'
+
+
+def test_part_longer_than_the_file_is_downloaded_again(url, tmp_path):
+    path = str(tmp_path / 'data.csv')
+    with open(path + '.part', 'wb') as f:
+        f.write(BODY + b'tail')
+    with open(path + '.meta.json', 'w') as f:
+        json.dump({'etag': '"v1"', 'complete': False}, f)
+    ingestion.download(url, path, backoff=0)
+
+    assert read(path) == BODY
+    assert 'Range' in Source.requests[0] and 'Range' not in Source.requests[1]
+
+
+def test_416_on_the_last_attempt_raises(url, tmp_path):
+    path = str(tmp_path / 'data.csv')
+    with open(path + '.part', 'wb') as f:
+        f.write(BODY + b'tail')
+    with open(path + '.meta.json', 'w') as f:
+        json.dump({'etag': '"v1"', 'complete': False}, f)
+
+    with pytest.raises(HTTPException):
+        ingestion.download(url, path, retries=0)
+
+
+def test_load_parses_the_files(url, tmp_path):
+    data = ingestion.load({'data.csv': url}, str(tmp_path))
+
+    assert data['data.csv'].shape == (19999, 2)
+    assert data['data.csv'].iloc[-1].tolist() == [19999, 19999 ** 2]